@@ -9,8 +9,8 @@ except ImportError:
 
 from tyumproxy import VERSION
 
-if sys.version_info < (3, 3):
-    sys.exit('requires python 3.3 and up')
+if sys.version_info < (3, 8):
+    sys.exit('requires python 3.8 and up')
 
 here = os.path.dirname(__file__)
 
@@ -23,10 +23,13 @@ setup(
     author_email='hurie83@gmail.com',
     url='https://github.com/hurie/tyumproxy',
     install_requires=[
-        'tornado==4.1',
-        'PyYAML==3.11',
+        'tornado>=6.0',
+        'PyYAML>=5.1',
         'parse',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     include_package_data=True,
     packages=[
         'tyumproxy',
@@ -47,7 +50,7 @@ setup(
         'Intended Audience :: Developers',
         'Intended Audience :: System Administrators',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 3.3',
+        'Programming Language :: Python :: 3.8',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ]
 )
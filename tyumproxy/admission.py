@@ -0,0 +1,99 @@
+"""
+Created on Oct 19, 2026
+
+@author: Azhar
+"""
+import hashlib
+from array import array
+from fnmatch import fnmatch
+
+from .util import parse_size
+
+
+class FrequencySketch(object):
+    """Count-min sketch of request frequency with one byte per counter.
+
+    Counters saturate at 255 and are halved once ``sample`` increments were
+    recorded so old popularity fades away.
+    """
+
+    def __init__(self, width=65536, depth=4, sample=None):
+        self.width = int(width)
+        self.depth = min(int(depth), 5)
+        self.sample = int(sample or self.width * 10)
+        self.rows = [array('B', bytes(self.width)) for _ in range(self.depth)]
+        self.additions = 0
+
+    def _indexes(self, key):
+        digest = hashlib.sha1(key.encode()).digest()
+        for i in range(self.depth):
+            yield int.from_bytes(digest[i * 4:i * 4 + 4], 'little') % self.width
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+    def add(self, key):
+        indexes = list(self._indexes(key))
+        count = min(row[i] for row, i in zip(self.rows, indexes))
+        if count < 255:
+            # conservative update, only raise the counters holding the minimum
+            for row, i in zip(self.rows, indexes):
+                if row[i] == count:
+                    row[i] = count + 1
+            count += 1
+
+        self.additions += 1
+        if self.additions >= self.sample:
+            self.reset()
+        return count
+
+    def reset(self):
+        for row in self.rows:
+            for i in range(self.width):
+                row[i] >>= 1
+        self.additions //= 2
+
+
+class AdmissionRule(object):
+    def __init__(self, min_hits=1, max_size=None):
+        self.min_hits = int(min_hits)
+        self.max_size = parse_size(max_size)
+
+
+class AdmissionPolicy(object):
+    """Decide whether a fetched object is worth writing to the cache.
+
+    Rules are looked up by fetch class name, non cacheable urls use the
+    ``uncacheable`` rule. An object is admitted once it was requested
+    ``min_hits`` times, is not larger than ``max_size`` and its content type
+    is not denied.
+    """
+    UNCACHEABLE = 'uncacheable'
+
+    def __init__(self, rules, sketch, deny_types=()):
+        self.rules = rules
+        self.sketch = sketch
+        self.deny_types = list(deny_types)
+        self.default = AdmissionRule()
+
+    @classmethod
+    def from_config(cls, cfg):
+        rules = {name: AdmissionRule(**(rule or {})) for name, rule in (cfg.get('classes') or {}).items()}
+        sketch = FrequencySketch(cfg.get('sketch_width', 65536), cfg.get('sketch_depth', 4))
+        return cls(rules, sketch, deny_types=(cfg.get('content_types') or {}).get('deny') or ())
+
+    def rule(self, name):
+        return self.rules.get(name, self.default)
+
+    def record(self, key):
+        return self.sketch.add(key)
+
+    def admit(self, key, name, size=None, content_type=None):
+        rule = self.rule(name)
+        if rule.max_size is not None and size is not None and size > rule.max_size:
+            return False
+
+        if content_type and any(fnmatch(content_type.lower(), p) for p in self.deny_types):
+            return False
+
+        return self.sketch.estimate(key) >= rule.min_hits
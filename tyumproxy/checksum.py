@@ -0,0 +1,270 @@
+"""
+Created on Oct 19, 2026
+
+@author: Azhar
+"""
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import re
+import shutil
+import sqlite3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import NamedTemporaryFile
+from xml.etree import ElementTree
+
+import tornado.ioloop
+from tornado.log import app_log
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+CHUNK_SIZE = 1024 * 1024
+
+NS_COMMON = '{http://linux.duke.edu/metadata/common}'
+NS_REPO = '{http://linux.duke.edu/metadata/repo}'
+
+METADATA_RE = re.compile(r'(^repomd\.xml|(^|-)primary\.(xml|sqlite)(\.(gz|bz2|xz|zst))?)$')
+
+ALGORITHMS = {
+    'sha': 'sha1',
+    'sha1': 'sha1',
+    'sha224': 'sha224',
+    'sha256': 'sha256',
+    'sha384': 'sha384',
+    'sha512': 'sha512',
+}
+
+OPENERS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+}
+
+if zstd is not None:
+    OPENERS['.zst'] = zstd.open
+
+
+def is_metadata(name):
+    return METADATA_RE.search(os.path.basename(name)) is not None
+
+
+def metadata_source(filename):
+    """Return what a metadata file describes, a newer file of the same source replaces an older one"""
+    name = os.path.basename(str(filename))
+    return os.path.dirname(str(filename)), 'repomd' if name == 'repomd.xml' else 'primary'
+
+
+def latest_metadata(filenames):
+    """Return the newest metadata file of every source among ``filenames``"""
+    latest = {}
+    for filename in filenames:
+        if not is_metadata(filename):
+            continue
+
+        source = metadata_source(filename)
+        mtime = os.stat(str(filename)).st_mtime
+        if source not in latest or mtime > latest[source][0]:
+            latest[source] = mtime, filename
+    return [filename for _, filename in latest.values()]
+
+
+def open_metadata(filename):
+    ext = os.path.splitext(filename)[1]
+    if ext == '.zst' and zstd is None:
+        raise ValueError('zstd metadata needs python 3.14 or the zstandard package, its repository is unverified')
+
+    opener = OPENERS.get(ext, open)
+    return opener(filename, 'rb')
+
+
+def read_repomd(filename):
+    entries = []
+    with open_metadata(filename) as f:
+        for _, elem in ElementTree.iterparse(f):
+            if elem.tag != NS_REPO + 'data':
+                continue
+
+            checksum = elem.find(NS_REPO + 'checksum')
+            location = elem.find(NS_REPO + 'location')
+            if checksum is not None and location is not None:
+                entries.append((location.get('href'), checksum.get('type'), checksum.text))
+            elem.clear()
+    return entries
+
+
+def read_primary_xml(filename):
+    entries = []
+    with open_metadata(filename) as f:
+        for _, elem in ElementTree.iterparse(f):
+            if elem.tag != NS_COMMON + 'package':
+                continue
+
+            checksum = elem.find(NS_COMMON + 'checksum')
+            location = elem.find(NS_COMMON + 'location')
+            if checksum is not None and location is not None:
+                entries.append((location.get('href'), checksum.get('type'), checksum.text))
+            elem.clear()
+    return entries
+
+
+def read_primary_sqlite(filename):
+    # sqlite needs a real file to open, uncompress it to a temporary one first
+    with open_metadata(filename) as src, NamedTemporaryFile(suffix='.sqlite') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        dst.flush()
+
+        db = sqlite3.connect(dst.name)
+        try:
+            return db.execute('SELECT location_href, checksum_type, pkgId FROM packages').fetchall()
+        finally:
+            db.close()
+
+
+def read_metadata(filename):
+    """Return ``(basename, algorithm, hexdigest)`` for every file listed in a metadata file"""
+    name = os.path.basename(filename)
+    try:
+        if name == 'repomd.xml':
+            entries = read_repomd(filename)
+        elif '.sqlite' in name:
+            entries = read_primary_sqlite(filename)
+        else:
+            entries = read_primary_xml(filename)
+    except Exception as e:
+        app_log.warning('unable to read %s: %s', filename, e)
+        return []
+
+    return [(os.path.basename(href), ALGORITHMS[algo], digest.lower())
+            for href, algo, digest in entries
+            if href and digest and algo in ALGORITHMS]
+
+
+def hash_file(filename, algorithms):
+    """Return ``(size, {algorithm: hexdigest})`` of a file"""
+    hashers = {algo: hashlib.new(algo) for algo in algorithms}
+    size = 0
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            for hasher in hashers.values():
+                hasher.update(chunk)
+    return size, {algo: hasher.hexdigest() for algo, hasher in hashers.items()}
+
+
+class StreamHasher(object):
+    def __init__(self, expected):
+        self.expected = expected
+        self.hashers = {algo: hashlib.new(algo) for algo, _ in expected}
+
+    def update(self, chunk):
+        for hasher in self.hashers.values():
+            hasher.update(chunk)
+
+    def digests(self):
+        return {(algo, hasher.hexdigest()) for algo, hasher in self.hashers.items()}
+
+    def matches(self):
+        return not self.expected.isdisjoint(self.digests())
+
+
+class ChecksumIndex(object):
+    """Known checksums keyed by file name.
+
+    Names come from the ``location`` of repomd and primary metadata so the
+    same package fetched from any mirror, or stored under a transposed path,
+    is checked against the same digests. Names are compared case-insensitive
+    since a transposed path is lowercased. A name listed with several digests
+    accepts any of them.
+
+    Metadata loaded again for a source, a refreshed repomd.xml or the new
+    primary of a repository, replaces what that source listed before so
+    names no longer referenced by any repository are dropped.
+    """
+
+    def __init__(self):
+        self._sums = {}
+        self._refs = Counter()
+        self._sources = {}
+        self._executor = None
+
+    def __len__(self):
+        return len(self._sums)
+
+    def __contains__(self, name):
+        return name.lower() in self._sums
+
+    def add(self, entries, source=None, mtime=0):
+        """Add ``entries``, returns False when ``source`` already has newer ones"""
+        entries = [(name.lower(), algo, digest) for name, algo, digest in entries]
+        if source is not None:
+            current = self._sources.get(source)
+            if current is not None:
+                if current[0] > mtime:
+                    return False
+                self._remove(current[1])
+            self._sources[source] = mtime, entries
+
+        for name, algo, digest in entries:
+            self._refs[name, algo, digest] += 1
+            self._sums.setdefault(name, set()).add((algo, digest))
+        return True
+
+    def _remove(self, entries):
+        for name, algo, digest in entries:
+            ref = name, algo, digest
+            self._refs[ref] -= 1
+            if self._refs[ref] > 0:
+                continue
+
+            del self._refs[ref]
+            sums = self._sums[name]
+            sums.discard((algo, digest))
+            if not sums:
+                del self._sums[name]
+
+    def expected(self, name):
+        return self._sums.get(name.lower())
+
+    def algorithms(self, name):
+        return {algo for algo, _ in self._sums.get(name.lower(), ())}
+
+    def hasher(self, name):
+        expected = self._sums.get(name.lower())
+        if not expected:
+            return None
+        return StreamHasher(expected)
+
+    def start(self, storage):
+        # older copies of a primary stay in the cache, only the newest one counts
+        for path in latest_metadata(path for key, path, _ in storage.items()):
+            self.load(path)
+
+    def load(self, filename):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+
+        mtime = os.stat(str(filename)).st_mtime
+        future = self._executor.submit(read_metadata, str(filename))
+        tornado.ioloop.IOLoop.current().add_future(future, lambda f: self._loaded(f, filename, mtime))
+
+    def _loaded(self, future, filename, mtime):
+        entries = future.result()
+        if self.add(entries, metadata_source(filename), mtime):
+            app_log.debug('loaded %d checksums from %s, %d names known', len(entries), filename, len(self))
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
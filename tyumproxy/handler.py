@@ -3,28 +3,53 @@ Created on Aug 15, 2014
 
 @author: Azhar
 """
+import asyncio
 import hashlib
-import socket
-from tempfile import NamedTemporaryFile
 from time import time
 from urllib.parse import urlsplit
-from pathlib import Path
 
-from tornado.httpclient import AsyncHTTPClient
-from tornado.httputil import HTTPHeaders
+from tornado.iostream import StreamClosedError
 from tornado.log import app_log
+from tornado.tcpclient import TCPClient
 import tornado.web
-import tornado.iostream
-import tornado.gen
 from tornado.web import HTTPError
 
+from .admission import AdmissionPolicy
+from .transfer import Transfer
+from .upstream import Upstream, UpstreamError, is_encoded
+
+
+class CacheFileHandler(tornado.web.StaticFileHandler):
+    """Browse the cache, objects are served from whichever tier holds them"""
+
+    def prepare(self):
+        self.application.active.add(self)
+        if self.application.draining:
+            self.set_header('Connection', 'close')
+
+    async def get(self, path, include_body=True):
+        self.root = str(self.application.storage.tier_of(path).path)
+        return await tornado.web.StaticFileHandler.get(self, path, include_body)
+
+    def on_connection_close(self):
+        self.application.active.discard(self)
+
+    def on_finish(self):
+        self.application.active.discard(self)
+
 
 class ProxyHandler(tornado.web.StaticFileHandler):
     CHUNK_SIZE = 64 * 1024
+    MAX_CHUNK_SIZE = 1024 * 1024
     SUPPORTED_METHODS = ['GET', 'CONNECT']
 
     def initialize(self, path, default_filename=None):
         self.cache_dir = path
+        self.storage = self.application.storage
+        self.scheduler = self.application.scheduler
+        self.admission = self.application.admission
+        self.mirrors = self.application.mirrors
+        self.transfers = self.application.transfers
         self.url_transpose = self.application.url_transpose
 
         tornado.web.StaticFileHandler.initialize(self, str(self.cache_dir))
@@ -33,60 +58,67 @@ class ProxyHandler(tornado.web.StaticFileHandler):
         raise NotImplementedError()
 
     def prepare(self):
-        self.cacheable_exts = ('.rpm', '.img', '.sqlite.bz2', '.sqlite.gz', '.xml', '.xml.gz', '.qcow2', '.raw.xz',
-                               '.iso', 'filelist.gz', 'vmlinuz')
+        self.cacheable_exts = ('.rpm', '.img', '.sqlite.bz2', '.sqlite.gz', '.sqlite.xz', '.sqlite.zst', '.xml',
+                               '.xml.gz', '.xml.xz', '.xml.zst', '.qcow2', '.raw.xz', '.iso', 'filelist.gz', 'vmlinuz')
 
         self.cacheable = False
-        self.cache_used = False
+        self.cache_key = None
         self.cache_file = None
-        self.cache_fd = None
         self.cache_url = False
+        self.cache_info = None
+        self.transfer = None
+        self.client_gone = False
+        self.chunk_size = self.CHUNK_SIZE
 
-        self.req_code = None
         self.req_path = None
-        self.req_headers = None
+
+        self.application.active.add(self)
+        if self.application.draining:
+            self.set_header('Connection', 'close')
 
     def is_cacheable(self, path):
         return path.endswith(self.cacheable_exts)
 
-    @tornado.gen.coroutine
-    @tornado.web.asynchronous
-    def get(self, path, include_body=True):
+    def is_conditional(self):
+        return 'If-Modified-Since' in self.request.headers or 'If-None-Match' in self.request.headers
+
+    async def get(self, path, include_body=True):
         self.req_path = path
         app_log.info('process %s', path)
 
         url = urlsplit(path)
 
+        if self.mirrors.match(self.request.uri):
+            return await self.get_mirror()
 
         self.cache_url = path.replace(url[0] + '://', '')
         self.cacheable = self.is_cacheable(url.path)
         app_log.debug('is cacheable %r', self.cacheable)
         if self.cacheable:
-            cache_file = self.url_transpose(path)
-            if not cache_file:
+            cache_key = self.url_transpose(path)
+            if not cache_key:
                 netloc = [x for x in reversed(url.netloc.split('.'))]
-                self.cache_file = self.cache_dir / '.'.join(netloc) / url.path[1:]
-            else:
-                self.cache_file = self.cache_dir / cache_file
+                cache_key = '.'.join(netloc) + url.path
+            self.cache_key = cache_key
 
         else:
             uri = self.request.uri.encode()
             cache_id = hashlib.sha1(uri).hexdigest()
-            cache_path = self.cache_dir / '~' / cache_id[:2]
-
-            cache_info = cache_path / (cache_id + '-url.txt')
-            if not cache_info.exists():
-                if not cache_info.parent.exists():
-                    cache_info.parent.mkdir(parents=True)
+            cache_path = '~/' + cache_id[:2]
 
-                with cache_info.open('w') as f:
-                    f.write(uri.decode())
-
-            self.cache_file = cache_path / (cache_id + '-data.txt')
+            self.cache_info = cache_path + '/' + cache_id + '-url.txt'
+            self.cache_key = cache_path + '/' + cache_id + '-data.txt'
 
         cache_time = None
-        if self.cache_file.exists():
-            self.cache_file = self.cache_file.resolve()
+        located = self.storage.locate(self.cache_key)
+        if located is None:
+            self.cache_file = self.storage.path_for(self.cache_key)
+        elif not located[0].exists():
+            app_log.info('%s disappeared', located[0])
+            self.storage.discard(self.cache_key)
+            self.cache_file = self.storage.path_for(self.cache_key)
+        else:
+            self.cache_file, tier = located
             cache_time = self.cache_file.stat().st_mtime
 
             lifetime = time() - int(self.settings['cache']['lifetime']) * 60 * 60
@@ -94,122 +126,181 @@ class ProxyHandler(tornado.web.StaticFileHandler):
             if cache_time > lifetime:
                 app_log.info('found %s', self.cache_file)
 
-                cache_url = self.cache_file.relative_to(self.cache_dir).as_posix()
-                return tornado.web.StaticFileHandler.get(self, cache_url)
+                self.root = str(tier.path)
+                return await tornado.web.StaticFileHandler.get(self, self.cache_key)
 
             app_log.info('%s lifetime exceeded', self.cache_file)
 
-        args = {k: v[0] for k, v in self.request.arguments.items()}
-
-        app_log.info('fetch %s', self.request.uri)
         if 'Range' in self.request.headers:
             del self.request.headers['Range']
 
-        self.client = AsyncHTTPClient()
-        self.client.fetch(self.request.uri,
-                          method=self.request.method,
-                          body=self.request.body,
-                          headers=self.request.headers,
-                          follow_redirects=False,
-                          if_modified_since=cache_time,
-                          allow_nonstandard_methods=True,
-                          connect_timeout=int(self.settings['proxy']['timeout']),
-                          request_timeout=2 ** 31 - 1,
-                          header_callback=self.process_header,
-                          streaming_callback=self.process_body,
-                          callback=self.process_finish)
-
-    def process_header(self, line):
-        header = line.strip()
-        app_log.debug('response header %s', header)
-        if header:
-            if self.req_headers is None:
-                self.req_headers = HTTPHeaders()
-                _, status, _ = header.split(' ', 2)
-                status = int(status)
-
-                if status == 599:
-                    # network error but cache file exists
-                    if self.cache_file.exists():
-                        status = 200
-                elif status == 304:
-                    status = 200
-                elif status == 200:
-                    app_log.debug('prepare temp file for %s', self.req_path)
-                    self.cache_fd = NamedTemporaryFile(dir=str(self.cache_dir), delete=False)
-
-                self.set_status(status)
+        transfer = self.transfers.get(self.cache_key)
+        if transfer is not None and transfer.shared:
+            app_log.info('join transfer of %s', transfer.url)
+        else:
+            self.admission.record(self.cache_key)
+            if self.cacheable:
+                admit_rule = self.scheduler.classify(self.request.uri).name
             else:
-                self.req_headers.parse_line(line)
-            return
-
-        for header in ('Date', 'Cache-Control', 'Server', 'Content-Type', 'Location'):
-            val = self.req_headers.get(header)
-            if val:
-                self.set_header(header, val)
+                admit_rule = AdmissionPolicy.UNCACHEABLE
+
+            transfer = Transfer(self.application, self.cache_key, self.request.uri,
+                                method=self.request.method,
+                                headers=self.request.headers,
+                                body=self.request.body or None,
+                                cache_file=self.cache_file if cache_time is not None else None,
+                                cache_time=cache_time,
+                                cache_info=self.cache_info,
+                                cacheable=self.cacheable,
+                                admit_rule=admit_rule).start()
+
+        self.transfer = transfer
+        transfer.join(self)
+        try:
+            await transfer.ready.wait()
+            if self.client_gone:
+                return
 
-        if 'content-encoding' not in self.req_headers:
-            val = self.req_headers.get('Content-Length')
-            if val:
-                self.set_header('Content-Length', val)
+            if transfer.code is None or transfer.code == 304:
+                # network error or not modified, the cached copy is still good
+                if self.cache_file.exists():
+                    app_log.info('use %s', self.cache_file)
+                    return await self.send_file(self.cache_file)
+
+                if transfer.code == 304 and self.is_conditional():
+                    # the condition was the client's own, its copy is still good
+                    self.set_status(304, transfer.reason)
+                    for header in ('Date', 'Cache-Control', 'Server', 'ETag', 'Last-Modified', 'Expires'):
+                        val = transfer.headers.get(header)
+                        if val:
+                            self.set_header(header, val)
+                    return self.finish()
+
+                raise HTTPError(502, transfer.error)
+
+            self.set_status(transfer.code, transfer.reason)
+            for header in ('Date', 'Cache-Control', 'Server', 'Content-Type', 'Location'):
+                val = transfer.headers.get(header)
+                if val:
+                    self.set_header(header, val)
+
+            if not is_encoded(transfer.headers):
+                val = transfer.headers.get('Content-Length')
+                if val:
+                    self.set_header('Content-Length', val)
+
+            await self.stream(transfer)
+        finally:
+            transfer.leave(self)
+
+    async def stream(self, transfer):
+        offset = 0
+        while not self.client_gone:
+            if transfer.fd is not None:
+                size = min(transfer.available - offset, self.chunk_size)
+                chunk = transfer.read(offset, size) if size > 0 else b''
+            else:
+                chunk = transfer.pop(self.chunk_size)
+
+            if chunk:
+                offset += len(chunk)
+                if not await self.send(chunk):
+                    return
+                continue
+
+            if transfer.done:
+                break
+            await transfer.changed.wait()
+
+        if transfer.error is not None:
+            # do not let the client take a broken transfer as complete
+            app_log.info('abort %s: %s', self.req_path, transfer.error)
+            self.request.connection.close()
+            return
 
-        self.flush()
+        self.finish()
 
-    def process_body(self, chunk):
-        if self._finished:
-            return
+    async def send_file(self, file):
+        with file.open('rb') as f:
+            while not self.client_gone:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                if not await self.send(chunk):
+                    return
 
-        if self.cache_fd is not None:
-            self.cache_fd.write(chunk)
+        app_log.debug('process file %s finish', file)
+        self.finish()
 
+    async def send(self, chunk):
+        """Write a chunk and wait for the client, adapting the chunk size to how fast it reads"""
         self.write(chunk)
-        self.flush()
-
-    def process_finish(self, response):
-        app_log.debug('process finish %s', self.req_path)
-        if self._finished or self.cache_used:
-            app_log.debug('skip process finish')
+        started = time()
+        try:
+            await self.flush()
+        except StreamClosedError:
+            self.client_gone = True
+            return False
+
+        elapsed = time() - started
+        if elapsed < 0.005:
+            self.chunk_size = min(self.chunk_size * 2, self.MAX_CHUNK_SIZE)
+        elif elapsed > 0.1:
+            self.chunk_size = max(self.chunk_size // 2, self.CHUNK_SIZE)
+        return True
+
+    async def get_mirror(self):
+        cached = self.mirrors.get(self.request.uri)
+        if cached is not None:
+            app_log.info('found mirror list %s', self.request.uri)
+            self.write_mirror(*cached)
             return
 
-        app_log.info('code %s fo %s', response.code, self.request.uri)
-
-        if response.code in (599, 304):
-            if self.cache_file.exists():
-                if response.code == 304:
-                    self.cache_file.touch()
-
-                app_log.info('use %s', self.cache_file)
-                self.cache_fd = self.cache_file.open('rb')
-                self.process_file()
-                return
-
-        elif 200 <= response.code < 300:
-            if self.cache_fd is not None:
-                self.cache_fd.close()
-
-                if self.cache_file.exists():
-                    self.cache_file.unlink()
-                elif not self.cache_file.parent.exists():
-                    self.cache_file.parent.mkdir(parents=True)
+        headers = self.request.headers
+        if 'Range' in headers:
+            del headers['Range']
+
+        chunks = []
+
+        async def collect(chunk):
+            chunks.append(chunk)
+
+        app_log.info('fetch mirror list %s', self.request.uri)
+        upstream = Upstream(self.request.uri,
+                            on_chunk=collect,
+                            headers=headers,
+                            connect_timeout=int(self.settings['proxy']['timeout']),
+                            follow_redirects=True)
+        try:
+            async with self.scheduler.slot(self.request.uri):
+                await upstream.fetch()
+        except UpstreamError as e:
+            app_log.info('unable to fetch %s: %s', self.request.uri, e)
+
+        if upstream.code == 200 and upstream.error is None:
+            content_type = upstream.response_headers.get('Content-Type', 'text/plain')
+            body = self.mirrors.rewrite(b''.join(chunks), content_type)
+            self.mirrors.put(self.request.uri, content_type, body)
+            self.write_mirror(content_type, body)
+            return
 
-                temp_file = Path(self.cache_dir) / self.cache_fd.name
-                temp_file.rename(self.cache_file)
+        cached = self.mirrors.get(self.request.uri, stale=True)
+        if cached is not None:
+            app_log.info('code %s for %s, use stale mirror list', upstream.code, self.request.uri)
+            self.write_mirror(*cached)
+            return
 
-                app_log.info('saved %s', self.cache_file)
+        if upstream.code is None:
+            raise HTTPError(502, upstream.error)
 
-        self.cache_fd = None
+        self.set_status(upstream.code, upstream.reason)
+        self.write(b''.join(chunks))
         self.finish()
 
-    def process_file(self):
-        chunk = self.cache_fd.read(self.CHUNK_SIZE)
-        if chunk:
-            self.write(chunk)
-            self.flush(callback=self.process_file)
-            return
-
-        self.cache_fd.close()
-        self.cache_fd = None
-        app_log.debug('process file %s finish', self.cache_file)
+    def write_mirror(self, content_type, body):
+        self.set_header('Content-Type', content_type)
+        self.set_header('Content-Length', len(body))
+        self.write(body)
         self.finish()
 
     def compute_etag(self):
@@ -221,50 +312,52 @@ class ProxyHandler(tornado.web.StaticFileHandler):
 
         return tornado.web.StaticFileHandler.compute_etag(self)
 
+    def on_connection_close(self):
+        self.client_gone = True
+        self.application.active.discard(self)
+
+        # the transfer stops once nobody reads it, wake up the reader so it returns
+        if getattr(self, 'transfer', None) is not None:
+            self.transfer.leave(self)
+            self.transfer.changed.notify_all()
+
     def on_finish(self):
         app_log.debug('on finish')
-        # sometimes, prepare is not called.
-        if not hasattr(self, 'cache_fd') or self.cache_fd is None:
-            return
-        self.cache_fd.close()
+        self.application.active.discard(self)
 
-    @tornado.web.asynchronous
-    def connect(self, path):
+    async def connect(self, path):
         app_log.info('CONNECT to %s', self.request.uri)
-        host, port = self.request.uri.split(':')
-        client = self.request.connection.stream
-
-        def read_from_client(data):
-            # app_log.debug('read from client\n%s', data)
-            upstream.write(data)
-
-        def read_from_upstream(data):
-            # app_log.debug('read from upstream\n%s', data)
-            client.write(data)
-
-        def client_close(data=None):
-            # app_log.debug('client close\n%s', data)
-            if upstream.closed():
-                return
-            if data:
-                upstream.write(data)
-            upstream.close()
+        host, port = self.request.uri.rsplit(':', 1)
 
-        def upstream_close(data=None):
-            # app_log.debug('upstream close\n%s', data)
-            if client.closed():
-                return
-            if data:
-                client.write(data)
-            client.close()
-
-        def start_tunnel():
-            app_log.debug('start connect tunnel')
-            client.read_until_close(client_close, read_from_client)
-            upstream.read_until_close(upstream_close, read_from_upstream)
-            client.write(b'HTTP/1.0 200 Connection established\r\n\r\n')
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        upstream = tornado.iostream.IOStream(s)
         app_log.debug('connect to upstream')
-        upstream.connect((host, int(port)), start_tunnel)
+        try:
+            upstream = await TCPClient().connect(host, int(port),
+                                                 timeout=int(self.settings['proxy']['timeout']))
+        except (OSError, StreamClosedError, asyncio.TimeoutError) as e:
+            app_log.info('unable to connect %s: %s', self.request.uri, e)
+            raise HTTPError(502)
+
+        # the tunnel owns the connection from here on, tornado must not answer it
+        self._auto_finish = False
+        client = self.request.connection.detach()
+
+        async def pipe(source, target):
+            try:
+                while True:
+                    data = await source.read_bytes(self.MAX_CHUNK_SIZE, partial=True)
+                    await target.write(data)
+            except StreamClosedError:
+                pass
+            finally:
+                source.close()
+                target.close()
+
+        app_log.debug('start connect tunnel')
+        try:
+            await client.write(b'HTTP/1.0 200 Connection established\r\n\r\n')
+            await asyncio.gather(pipe(client, upstream), pipe(upstream, client))
+        except StreamClosedError:
+            client.close()
+            upstream.close()
+        finally:
+            self.application.active.discard(self)
@@ -4,42 +4,66 @@ Created on Aug 15, 2014
 @author: Azhar
 """
 import argparse
+import asyncio
 import logging
 import logging.config
 import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import weakref
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import timedelta
 from pathlib import Path
+from time import time
 
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.template
 import tornado.web
 from tornado.log import app_log
-from tornado.web import StaticFileHandler
 import yaml
 
 from . import template, yaml_anydict
-from .handler import ProxyHandler
+from .admission import AdmissionPolicy
+from .checksum import ChecksumIndex, hash_file, latest_metadata, metadata_source, read_metadata
+from .handler import CacheFileHandler, ProxyHandler
+from .mirror import MirrorRewriter
+from .scheduler import FetchScheduler
+from .segment import SegmentPolicy
+from .storage import TieredStorage
 from tyumproxy.util import UrlTranspose
-from .util import LoaderMapAsOrderedDict
+from .util import LoaderMapAsOrderedDict, parse_size
 
 
 logging.basicConfig()
 _log = logging.getLogger(__name__)
 
 CONFIG_FILENAME = 'tyumproxy.yml'
+LISTEN_FDS = 'TYUMPROXY_LISTEN_FDS'
+READY_FD = 'TYUMPROXY_READY_FD'
 
 
 class Application(tornado.web.Application):
     def __init__(self, cfg, debug=False):
-        self.cache_path = Path(cfg['cache']['path']).resolve()
-
-        if 'transpose' in cfg:
-            self.url_transpose = UrlTranspose(cfg['transpose'])
-        else:
-            self.url_transpose = lambda: None
+        self.storage = TieredStorage.from_config(cfg['cache'])
+        self.cache_path = self.storage.fast.path
+        self.scheduler = FetchScheduler.from_config(cfg['scheduler'])
+        self.checksums = ChecksumIndex()
+        self.admission = AdmissionPolicy.from_config(cfg['admission'])
+        self.mirrors = MirrorRewriter.from_config(cfg['mirrors'])
+        self.segments = SegmentPolicy.from_config(cfg['segments'])
+        self.url_transpose = self.make_transpose(cfg)
+        self.active = set()
+        self.transfers = {}
+        self.connections = weakref.WeakKeyDictionary()
+        self.draining = False
 
         handlers = [
-            (r"/~/(.*)", StaticFileHandler, {'path': cfg['cache']['path']}),
+            (r"/~/(.*)", CacheFileHandler, {'path': str(self.cache_path)}),
             (r"(.*)", ProxyHandler, {'path': self.cache_path}),
         ]
 
@@ -47,6 +71,55 @@ class Application(tornado.web.Application):
                                          debug=debug,
                                          **cfg)
 
+    def start_request(self, server_conn, request_conn):
+        # remember the request each client connection is on, it waits for the next one when idle
+        self.connections[server_conn] = request_conn
+        return tornado.web.Application.start_request(self, server_conn, request_conn)
+
+    def close_idle(self):
+        """Close keep-alive connections waiting for another request"""
+        busy = {handler.request.connection for handler in self.active}
+        for request_conn in list(self.connections.values()):
+            # a finished response may still sit in the write buffer
+            stream = request_conn.stream
+            if request_conn not in busy and stream is not None and not stream.writing():
+                request_conn.close()
+
+    @staticmethod
+    def make_transpose(cfg):
+        if 'transpose' in cfg:
+            return UrlTranspose(cfg['transpose'])
+        return lambda url: None
+
+    def reload(self, cfg):
+        """Swap in settings that do not need a restart, handlers pick them up on their next request"""
+        for section in ('server', 'scheduler'):
+            if cfg.get(section) != self.settings.get(section):
+                app_log.warning('%s settings changed, restart to apply them', section)
+
+        cache = dict(cfg['cache'])
+        for key in ('path', 'tiers', 'quarantine'):
+            if cache.get(key) != self.settings['cache'].get(key):
+                app_log.warning('cache %s changed, restart to apply it', key)
+            cache[key] = self.settings['cache'].get(key)
+
+        url_transpose = self.make_transpose(cfg)
+        admission = AdmissionPolicy.from_config(cfg['admission'])
+        admission.sketch = self.admission.sketch
+        mirrors = MirrorRewriter.from_config(cfg['mirrors'])
+        segments = SegmentPolicy.from_config(cfg['segments'])
+
+        # everything is built, nothing below can fail half way
+        self.url_transpose = url_transpose
+        self.admission = admission
+        self.mirrors = mirrors
+        self.segments = segments
+        self.settings['cache'] = cache
+        self.settings['proxy'] = cfg['proxy']
+        self.settings['transpose'] = cfg.get('transpose')
+        self.storage.promote_hits = int(cache.get('promote_hits', 2))
+        self.storage.set_rebalance_interval(int(cache.get('rebalance_interval', 60)))
+
 
 def merge_dict(source, other):
     for key in other:
@@ -65,10 +138,10 @@ def load_config(filename):
         raise Exception('{} not found'.format(filename))
 
     default_file = Path(template.__file__).resolve().parent / 'config.yml'
-    default_cfg = yaml.load(default_file.open('r'))
+    default_cfg = yaml.load(default_file.open('r'), Loader=yaml.SafeLoader)
 
     try:
-        cfg = yaml.load(filename.open('r')) or {}
+        cfg = yaml.load(filename.open('r'), Loader=yaml.SafeLoader) or {}
     except:
         raise Exception('Unable to load configuration file {}'.format(filename))
 
@@ -166,6 +239,8 @@ def setup(args):
         port = ask('Port to listen', 'Port range is 0 - 65535', 5000, cast=int)
         cache_dir = ask_path('Cache directory', default=template_cfg['cache']['path'])
         log_dir = ask_path('Application log path', default='.')
+        bandwidth = ask('Upstream bandwidth, e.g. 80M, 0 for no cap', 'Invalid size', '0',
+                        cast=lambda v: parse_size(v) is not None and v)
     except KeyboardInterrupt:
         print()
         print('Setup canceled!')
@@ -181,6 +256,7 @@ def setup(args):
         log_dir.mkdir(parents=True)
     log_dir = log_dir.resolve()
     template_cfg['server']['port'] = port
+    template_cfg['scheduler']['bandwidth'] = bandwidth
     template_cfg['cache']['dir'] = str(cache_dir)
 
     for handler in template_cfg['logging']['handlers'].values():
@@ -203,6 +279,138 @@ def setup(args):
         f.write(t.generate(**template_cfg).decode())
 
 
+def verify(args, cfg):
+    storage = TieredStorage.from_config(cfg['cache'])
+    storage.scan()
+
+    quarantine = Path(cfg['cache']['quarantine'])
+    checksums = ChecksumIndex()
+
+    started = time()
+    with ProcessPoolExecutor(args.jobs) as pool:
+        metadata = [str(path) for path in latest_metadata(path for key, path, _ in storage.items())]
+        for filename, entries in zip(metadata, pool.map(read_metadata, metadata)):
+            checksums.add(entries, metadata_source(filename))
+        print('loaded {} checksums from {} metadata files'.format(len(checksums), len(metadata)))
+
+        jobs = {}
+        skipped = 0
+        for key, path, _ in storage.items():
+            name = os.path.basename(key)
+            if name not in checksums:
+                skipped += 1
+                continue
+            jobs[pool.submit(hash_file, str(path), checksums.algorithms(name))] = key, path
+
+        total = failed = 0
+        for future in as_completed(jobs):
+            key, path = jobs[future]
+            try:
+                size, digests = future.result()
+            except OSError as e:
+                print('unable to read {}: {}'.format(path, e))
+                continue
+
+            total += size
+            if checksums.expected(os.path.basename(key)).isdisjoint(digests.items()):
+                failed += 1
+                target = quarantine / key
+                if not target.parent.exists():
+                    target.parent.mkdir(parents=True)
+                shutil.move(str(path), str(target))
+                print('mismatch {}, moved to {}'.format(path, target))
+
+    elapsed = max(time() - started, 0.001)
+    print('verified {} files, {} bytes in {:.1f}s ({:.1f} MiB/s)'.format(
+        len(jobs), total, elapsed, total / elapsed / 1024 / 1024))
+    print('{} mismatch, {} without known checksum'.format(failed, skipped))
+    return failed == 0
+
+
+def listen_sockets(port):
+    fds = os.environ.pop(LISTEN_FDS, None)
+    if not fds:
+        return tornado.netutil.bind_sockets(port)
+
+    sockets = []
+    for item in fds.split(','):
+        fd, family = (int(x) for x in item.split(':'))
+        sockets.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+        os.close(fd)
+    app_log.info('inherited %d listening sockets', len(sockets))
+    return sockets
+
+
+def notify_ready():
+    """Tell the process handing off to us that the inherited sockets are served"""
+    fd = os.environ.pop(READY_FD, None)
+    if fd is None:
+        return
+
+    try:
+        os.write(int(fd), b'1')
+    except OSError as e:
+        app_log.warning('unable to notify old process: %s', e)
+    finally:
+        os.close(int(fd))
+
+
+def handoff(application, server, sockets, drain_timeout):
+    """Start a new process on the same listening sockets and drain this one"""
+    ioloop = tornado.ioloop.IOLoop.current()
+
+    ready, notify = os.pipe()
+    env = dict(os.environ)
+    env[LISTEN_FDS] = ','.join('{}:{}'.format(s.fileno(), int(s.family)) for s in sockets)
+    env[READY_FD] = str(notify)
+    fds = [s.fileno() for s in sockets] + [notify]
+
+    try:
+        child = subprocess.Popen([sys.executable, '-m', 'tyumproxy.main'] + sys.argv[1:], env=env, pass_fds=fds)
+    except OSError as e:
+        app_log.error('unable to start new process: %s', e)
+        os.close(ready)
+        return
+    finally:
+        os.close(notify)
+    app_log.info('started new process %d', child.pid)
+
+    def check(fd, events):
+        ioloop.remove_handler(fd)
+        notified = os.read(fd, 1)
+        os.close(fd)
+
+        # the pipe closes without a byte when the new process fails before it listens
+        if not notified:
+            app_log.error('new process %d did not come up, keep serving', child.pid)
+            return
+
+        app_log.info('stop accepting, draining %d active transfers', len(application.active))
+        server.stop()
+        application.storage.stop_rebalance()
+        application.draining = True
+
+        deadline = time() + drain_timeout
+
+        def drain():
+            # open keep-alive connections would keep sending requests here
+            application.close_idle()
+
+            busy = len(application.active) + len(application.transfers)
+            if busy and time() < deadline:
+                ioloop.add_timeout(timedelta(seconds=1), drain)
+                return
+
+            if busy:
+                app_log.warning('drain timeout, dropping %d requests and transfers', busy)
+            ioloop.stop()
+
+        drain()
+
+    # keep accepting until the new process serves the sockets
+    ioloop.add_handler(ready, check, ioloop.READ)
+
+
 def start(args, cfg):
     application = Application(cfg, args.debug)
 
@@ -213,23 +421,40 @@ def start(args, cfg):
     if args.level is not None:
         logging.root.setLevel(args.level)
 
+    inherited = LISTEN_FDS in os.environ
+    if inherited:
+        # the old process may still commit objects while it drains
+        application.storage.probe_until = time() + int(cfg['server']['drain_timeout'])
+
     # listen to port
     port = cfg['server']['port']
     try:
-        application.listen(port)
+        sockets = listen_sockets(port)
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(sockets)
         app_log.info('listening port %s', port)
     except OSError:
         app_log.error('unable to listen port %s', port)
         return
 
-    ioloop = tornado.ioloop.IOLoop.instance()
+    notify_ready()
+
+    # walking a large cache takes a while, lookups probe the tiers until it is done
+    application.storage.start(lambda: application.checksums.start(application.storage))
 
-    # prevent block for IO allowed ctrl-c to pass
-    # http://stackoverflow.com/a/9578595
-    def set_ping(timeout):
-        ioloop.add_timeout(timeout, lambda: set_ping(timeout))
+    ioloop = tornado.ioloop.IOLoop.current()
 
-    set_ping(timedelta(seconds=0.5))
+    def reload():
+        app_log.info('reload %s', args.config)
+        try:
+            application.reload(load_config(args.config))
+        except Exception:
+            app_log.exception('unable to reload configuration')
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGHUP, reload)
+    loop.add_signal_handler(signal.SIGUSR2, handoff, application, server, sockets,
+                            int(cfg['server']['drain_timeout']))
 
     # start main loop
     try:
@@ -243,6 +468,8 @@ def start(args, cfg):
         raise
 
     ioloop.stop()
+    application.storage.stop()
+    application.checksums.stop()
     app_log.info('Closed')
     return True
 
@@ -261,6 +488,11 @@ def main():
     cmd.add_argument('--debug', default=False, action='store_true')
     cmd.set_defaults(cmd='start')
 
+    # cache verification
+    cmd = subparsers.add_parser('verify')
+    cmd.add_argument('--jobs', type=int, default=None)
+    cmd.set_defaults(cmd='verify')
+
     # configuration setup
     cmd = subparsers.add_parser('setup')
     cmd.add_argument('--replace', default=False, action='store_true')
@@ -289,6 +521,11 @@ def main():
         raise
 
     setup_logging(cfg)
+    if args.cmd == 'verify':
+        if not verify(args, cfg):
+            sys.exit(1)
+        return
+
     start(args, cfg)
 
 
@@ -0,0 +1,128 @@
+"""
+Created on Oct 19, 2026
+
+@author: Azhar
+"""
+from collections import OrderedDict
+from fnmatch import fnmatch
+from io import BytesIO
+from time import time
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+
+from tornado.log import app_log
+
+NAMESPACES = {
+    '': 'http://www.metalinker.org/',
+    'mm0': 'http://fedorahosted.org/mirrormanager',
+}
+
+for prefix, uri in NAMESPACES.items():
+    ElementTree.register_namespace(prefix, uri)
+
+
+class MirrorRewriter(object):
+    """Rewrite mirrorlist and metalink documents to one stable mirror order.
+
+    Mirrors listed in ``preferred`` come first in that order, every other
+    mirror follows sorted by host with plain http ahead of other schemes, so
+    all clients see the same list and pick the same mirror. Rewritten
+    documents are kept in memory for ``lifetime`` seconds.
+    """
+
+    def __init__(self, patterns=(), preferred=(), limit=None, lifetime=300, max_entries=1024):
+        self.patterns = list(patterns)
+        self.preferred = [p.lower() for p in preferred]
+        self.limit = int(limit) if limit else None
+        self.lifetime = int(lifetime)
+        self.max_entries = int(max_entries)
+
+        self._cache = OrderedDict()
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(patterns=cfg.get('patterns') or (),
+                   preferred=cfg.get('preferred') or (),
+                   limit=cfg.get('limit'),
+                   lifetime=cfg.get('lifetime', 300))
+
+    def match(self, url):
+        return any(fnmatch(url, p) for p in self.patterns)
+
+    def get(self, url, stale=False):
+        """Return ``(content_type, body)`` of a cached document or ``None``"""
+        entry = self._cache.get(url)
+        if entry is None:
+            return None
+
+        expires, content_type, body = entry
+        if not stale and expires < time():
+            return None
+
+        self._cache.move_to_end(url)
+        return content_type, body
+
+    def put(self, url, content_type, body):
+        self._cache[url] = time() + self.lifetime, content_type, body
+        self._cache.move_to_end(url)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def rank(self, url):
+        url = url.strip().lower()
+        parts = urlsplit(url)
+        # only plain http goes through the cache, https is tunnelled and yum skips rsync
+        uncached = parts.scheme != 'http'
+        for no, p in enumerate(self.preferred):
+            if parts.netloc == p or url.startswith(p):
+                return no, uncached, parts.netloc, url
+        return len(self.preferred), uncached, parts.netloc, url
+
+    def order(self, urls):
+        urls = sorted(urls, key=self.rank)
+        if self.limit:
+            urls = urls[:self.limit]
+        return urls
+
+    def equivalents(self, url):
+        """Return ``url`` followed by the same path on every other preferred mirror"""
+        prefixes = [p for p in self.preferred if '://' in p]
+        for p in prefixes:
+            if url.lower().startswith(p):
+                path = url[len(p):]
+                return [url] + [q + path for q in prefixes if q != p]
+        return [url]
+
+    def rewrite(self, body, content_type=None):
+        if 'metalink' in (content_type or '') or body.lstrip().startswith(b'<'):
+            try:
+                return self.rewrite_metalink(body)
+            except ElementTree.ParseError as e:
+                app_log.warning('unable to parse metalink: %s', e)
+                return body
+        return self.rewrite_mirrorlist(body)
+
+    def rewrite_mirrorlist(self, body):
+        lines = body.decode('utf-8', 'replace').splitlines()
+        comments = [l for l in lines if l.startswith('#')]
+        urls = [l.strip() for l in lines if l.strip() and not l.startswith('#')]
+        return '\n'.join(comments + self.order(urls)).encode() + b'\n'
+
+    def rewrite_metalink(self, body):
+        tree = ElementTree.parse(BytesIO(body))
+        for resources in tree.iter('{%s}resources' % NAMESPACES['']):
+            elements = list(resources)
+            for elem in elements:
+                resources.remove(elem)
+
+            elements = sorted(elements, key=lambda e: self.rank(e.text or ''))
+            if self.limit:
+                elements = elements[:self.limit]
+
+            for no, elem in enumerate(elements):
+                elem.set('preference', str(max(100 - no, 1)))
+                resources.append(elem)
+
+        out = BytesIO()
+        tree.write(out, encoding='utf-8', xml_declaration=True)
+        return out.getvalue()
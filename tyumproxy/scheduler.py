@@ -0,0 +1,203 @@
+"""
+Created on Oct 19, 2026
+
+@author: Azhar
+"""
+import asyncio
+import heapq
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager
+from fnmatch import fnmatch
+from time import time
+from urllib.parse import urlsplit
+
+from tornado.log import app_log
+
+from .util import parse_size
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time()
+
+    def refill(self):
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self):
+        """Seconds to wait before the bucket is positive again"""
+        self.refill()
+        if self.tokens > 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def consume(self, size):
+        # tokens may go negative so a chunk larger than the burst still passes
+        self.tokens -= size
+
+
+class FetchClass(object):
+    def __init__(self, name, priority, patterns=(), concurrency=None, bandwidth=None):
+        self.name = name
+        self.priority = priority
+        self.patterns = list(patterns)
+        self.concurrency = int(concurrency) if concurrency else None
+        self.bucket = TokenBucket(parse_size(bandwidth)) if bandwidth else None
+
+        self.active = 0
+        self.queue = deque()
+
+    def match(self, path):
+        return any(fnmatch(path, p) for p in self.patterns)
+
+    def has_slot(self):
+        return self.concurrency is None or self.active < self.concurrency
+
+    def __repr__(self):
+        return '<FetchClass {} {}/{} queued {}>'.format(self.name, self.active, self.concurrency, len(self.queue))
+
+
+class FetchJob(object):
+    def __init__(self, cls, url):
+        self.cls = cls
+        self.url = url
+        self.future = asyncio.get_event_loop().create_future()
+        self.cancelled = False
+        self.started = False
+        self.queued = time()
+
+
+class FetchScheduler(object):
+    """Priority queue for upstream connections.
+
+    Fetches are sorted into classes by the path of their url, earlier classes
+    having higher priority. A class never runs more than its own concurrency,
+    and every class but the first one also shares ``max_active`` so latency
+    sensitive fetches are never stuck behind bulk downloads. Bandwidth caps
+    are token buckets awaited for every chunk, so an empty bucket stops the
+    socket from being read. Tokens of the global bucket go to waiting chunks
+    of earlier classes first, whatever the number of connections of later
+    ones.
+    """
+
+    def __init__(self, classes, default=None, max_active=None, bandwidth=None):
+        self.classes = classes
+        self.default = default or classes[-1]
+        self.max_active = int(max_active) if max_active else None
+        self.bucket = TokenBucket(parse_size(bandwidth)) if bandwidth else None
+
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        classes = [FetchClass(c['name'], no,
+                              patterns=c.get('patterns') or (),
+                              concurrency=c.get('concurrency'),
+                              bandwidth=c.get('bandwidth'))
+                   for no, c in enumerate(cfg.get('classes') or [{'name': 'default'}])]
+
+        default = [c for c in classes if c.name == cfg.get('default')]
+        return cls(classes,
+                   default=default[0] if default else None,
+                   max_active=cfg.get('max_active'),
+                   bandwidth=cfg.get('bandwidth'))
+
+    @property
+    def active(self):
+        return sum(c.active for c in self.classes[1:])
+
+    def classify(self, url):
+        path = urlsplit(url).path
+        for cls in self.classes:
+            if cls.match(path):
+                return cls
+        return self.default
+
+    @asynccontextmanager
+    async def slot(self, url):
+        """Wait until ``url`` may be fetched, the slot is freed on exit"""
+        cls = self.classify(url)
+        job = FetchJob(cls, url)
+        app_log.debug('queue %s as %s', url, cls.name)
+
+        cls.queue.append(job)
+        self.dispatch()
+        try:
+            await job.future
+            yield job
+        finally:
+            self.release(job)
+
+    def release(self, job):
+        if job.started:
+            job.cls.active -= 1
+        else:
+            job.cancelled = True
+        self.dispatch()
+
+    def dispatch(self):
+        for cls in self.classes:
+            while cls.queue and cls.has_slot():
+                if cls.priority > 0 and self.max_active is not None and self.active >= self.max_active:
+                    return
+
+                job = cls.queue.popleft()
+                if job.cancelled:
+                    continue
+                self.start(job)
+
+    def start(self, job):
+        cls = job.cls
+        cls.active += 1
+        job.started = True
+        app_log.debug('start %s as %s after %.3fs', job.url, cls.name, time() - job.queued)
+        job.future.set_result(None)
+
+    async def throttle(self, job, size):
+        bucket = job.cls.bucket
+        if bucket is not None:
+            while True:
+                delay = bucket.delay()
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+            bucket.consume(size)
+
+        if self.bucket is None:
+            return
+
+        if not self._waiters and not self.bucket.delay():
+            self.bucket.consume(size)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (job.cls.priority, next(self._seq), size, future))
+        self.grant()
+        await future
+
+    def grant(self):
+        """Hand global tokens to waiting chunks, highest priority first"""
+        while self._waiters:
+            delay = self.bucket.delay()
+            if delay:
+                if self._timer is None:
+                    self._timer = asyncio.get_event_loop().call_later(delay, self._regrant)
+                return
+
+            _, _, size, future = heapq.heappop(self._waiters)
+            if future.done():
+                # the fetch was cancelled while waiting
+                continue
+            self.bucket.consume(size)
+            future.set_result(None)
+
+    def _regrant(self):
+        self._timer = None
+        self.grant()
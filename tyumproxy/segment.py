@@ -0,0 +1,183 @@
+"""
+Created on Oct 19, 2026
+
+@author: Azhar
+"""
+import asyncio
+import os
+import re
+from fnmatch import fnmatch
+from urllib.parse import urlsplit
+
+from tornado.httputil import HTTPHeaders
+from tornado.log import app_log
+
+from .upstream import Upstream, UpstreamError, is_encoded
+from .util import parse_size
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class Segment(object):
+    def __init__(self, no, start, end):
+        self.no = no
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.tries = 0
+        self.job = None
+
+    @property
+    def done(self):
+        return self.pos >= self.end
+
+    def __repr__(self):
+        return '<Segment {} {}-{} at {}>'.format(self.no, self.start, self.end, self.pos)
+
+
+class SegmentedDownload(object):
+    """Fetch one object as several byte ranges into a preallocated file.
+
+    Segments are spread over ``urls`` round robin and a failed segment is
+    retried from where it stopped on the next url. Every range must come from
+    the object the probe saw, ``probe`` holds its response headers.
+    ``on_progress`` is called whenever the contiguous prefix of the file grows.
+    """
+
+    def __init__(self, scheduler, urls, size, fd, count, headers, timeout, on_progress, probe=None):
+        self.scheduler = scheduler
+        self.urls = urls
+        self.size = size
+        self.fd = fd
+        self.headers = headers
+        self.timeout = timeout
+        self.on_progress = on_progress
+        self.etag = probe.get('ETag') if probe is not None else None
+        self.last_modified = probe.get('Last-Modified') if probe is not None else None
+
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(self.fd, size)
+
+        step = -(-size // count)
+        self.segments = [Segment(no, start, min(start + step, size))
+                         for no, start in enumerate(range(0, size, step))]
+        self.contiguous = 0
+        self.cancelled = False
+
+        self._upstreams = set()
+        self._tasks = []
+
+    async def run(self):
+        self._tasks = [asyncio.ensure_future(self.fetch(s)) for s in self.segments]
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            self.cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        for upstream in list(self._upstreams):
+            upstream.abort('cancelled')
+        for task in self._tasks:
+            task.cancel()
+
+    async def fetch(self, segment):
+        while not segment.done:
+            if segment.tries >= len(self.urls) * 2:
+                raise UpstreamError('segment {} failed'.format(segment.no))
+
+            url = self.urls[(segment.no + segment.tries) % len(self.urls)]
+            segment.tries += 1
+
+            headers = HTTPHeaders(self.headers)
+            headers['Range'] = 'bytes={}-{}'.format(segment.pos, segment.end - 1)
+            validator = self.validator(url)
+            if validator is not None:
+                headers['If-Range'] = validator
+            app_log.debug('fetch segment %r from %s', segment, url)
+
+            upstream = Upstream(url,
+                                on_headers=lambda u, url=url: self.process_header(segment, url, u),
+                                on_chunk=lambda chunk: self.process_body(segment, chunk),
+                                headers=headers,
+                                connect_timeout=self.timeout,
+                                follow_redirects=True)
+            self._upstreams.add(upstream)
+            try:
+                async with self.scheduler.slot(url) as job:
+                    segment.job = job
+                    await upstream.fetch()
+            except UpstreamError as e:
+                if self.cancelled:
+                    raise
+                app_log.warning('segment %r failed: %s', segment, e)
+            finally:
+                self._upstreams.discard(upstream)
+
+    def validator(self, url):
+        # etags differ between servers, other mirrors are only held to the modification time
+        if url == self.urls[0] and self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def process_header(self, segment, url, upstream):
+        headers = upstream.response_headers
+        match = CONTENT_RANGE_RE.search(headers.get('Content-Range', ''))
+        if upstream.code != 206 or match is None or int(match.group(1)) != segment.pos:
+            upstream.abort('range not honoured by {}'.format(upstream.url))
+        elif match.group(3) != str(self.size):
+            upstream.abort('{} holds {} bytes, expected {}'.format(upstream.url, match.group(3), self.size))
+        elif not self.is_same(url, headers):
+            upstream.abort('{} holds another version'.format(upstream.url))
+
+    def is_same(self, url, headers):
+        etag = headers.get('ETag')
+        if url == self.urls[0] and self.etag and etag and etag != self.etag:
+            return False
+
+        last_modified = headers.get('Last-Modified')
+        return not (self.last_modified and last_modified and last_modified != self.last_modified)
+
+    async def process_body(self, segment, chunk):
+        chunk = chunk[:segment.end - segment.pos]
+        if chunk:
+            os.pwrite(self.fd, chunk, segment.pos)
+            segment.pos += len(chunk)
+            self.advance()
+            await self.scheduler.throttle(segment.job, len(chunk))
+
+    def advance(self):
+        contiguous = self.size
+        for segment in self.segments:
+            if not segment.done:
+                contiguous = segment.pos
+                break
+
+        if contiguous > self.contiguous:
+            self.contiguous = contiguous
+            self.on_progress()
+
+
+class SegmentPolicy(object):
+    def __init__(self, patterns=(), min_size=None, count=4):
+        self.patterns = list(patterns)
+        self.min_size = parse_size(min_size)
+        self.count = int(count)
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(patterns=cfg.get('patterns') or (),
+                   min_size=cfg.get('min_size'),
+                   count=cfg.get('count', 4))
+
+    def match(self, url):
+        return self.count > 1 and any(fnmatch(urlsplit(url).path, p) for p in self.patterns)
+
+    def eligible(self, headers):
+        if 'bytes' not in headers.get('Accept-Ranges', '') or is_encoded(headers):
+            return False
+
+        size = headers.get('Content-Length')
+        return size is not None and int(size) >= (self.min_size or 0)
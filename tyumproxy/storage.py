@@ -0,0 +1,348 @@
+"""
+Created on Oct 19, 2026
+
+@author: Azhar
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import time
+
+import tornado.ioloop
+from tornado.log import app_log
+
+from .util import parse_size
+
+DATA_SUFFIX = '-data.txt'
+INFO_SUFFIX = '-url.txt'
+
+
+def sidecar(key):
+    """Return the key of the url file kept next to an uncacheable object or ``None``"""
+    if key.endswith(DATA_SUFFIX):
+        return key[:-len(DATA_SUFFIX)] + INFO_SUFFIX
+    return None
+
+
+class Tier(object):
+    def __init__(self, path, capacity=None):
+        self.path = Path(path)
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+        self.path = self.path.resolve()
+
+        self.capacity = parse_size(capacity)
+        self.usage = 0
+
+    def has_room(self, size):
+        return self.capacity is None or self.usage + size <= self.capacity
+
+    def __repr__(self):
+        return '<Tier {} {}/{}>'.format(self.path, self.usage, self.capacity)
+
+
+class Entry(object):
+    __slots__ = ('tier', 'size', 'hits', 'atime')
+
+    def __init__(self, tier, size, hits=0, atime=None):
+        self.tier = tier
+        self.size = size
+        self.hits = hits
+        self.atime = atime or time()
+
+
+class TieredStorage(object):
+    """Cache objects spread over an ordered list of tiers, fastest first.
+
+    Objects are always written to the first tier. Every known object is kept
+    in an in-memory index so a lookup never has to stat each tier, only while
+    the startup scan builds that index lookups probe the tiers. A periodic
+    rebalance demotes the least used objects of an over-full tier to the next
+    one, and hits on a slower tier promote the object back in the background.
+    """
+    HIGH_WATERMARK = 0.95
+    LOW_WATERMARK = 0.85
+    STALE_TEMP = 24 * 60 * 60
+
+    def __init__(self, tiers, promote_hits=2, rebalance_interval=60, workers=2):
+        self.tiers = tiers
+        self.promote_hits = promote_hits
+        self.rebalance_interval = rebalance_interval
+
+        self.probe_until = 0
+        self.scanning = False
+
+        self._index = {}
+        self._moving = set()
+        self._executor = ThreadPoolExecutor(workers)
+        self._periodic = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        tiers = cfg.get('tiers') or [{'path': cfg['path']}]
+        return cls([Tier(t['path'], t.get('capacity')) for t in tiers],
+                   promote_hits=int(cfg.get('promote_hits', 2)),
+                   rebalance_interval=int(cfg.get('rebalance_interval', 60)))
+
+    @property
+    def fast(self):
+        return self.tiers[0]
+
+    def start(self, callback=None):
+        """Index the tiers in the background, ``callback`` runs once the index is complete"""
+        self.scanning = True
+        future = self._executor.submit(self.walk)
+        tornado.ioloop.IOLoop.current().add_future(future, lambda f: self._scanned(f, callback))
+
+    def stop(self):
+        self.stop_rebalance()
+        self._executor.shutdown(wait=False)
+
+    def start_rebalance(self):
+        self.stop_rebalance()
+        self._periodic = tornado.ioloop.PeriodicCallback(self.rebalance, self.rebalance_interval * 1000)
+        self._periodic.start()
+
+    def set_rebalance_interval(self, interval):
+        """Change how often tiers are rebalanced, a running timer is restarted with it"""
+        if interval == self.rebalance_interval:
+            return
+
+        self.rebalance_interval = interval
+        if self._periodic is not None:
+            self.start_rebalance()
+
+    def stop_rebalance(self):
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+
+    def scan(self):
+        self._index = self.walk()
+        self._recount()
+
+    def walk(self):
+        """Return a fresh index of every tier, safe to run off the ioloop"""
+        index = {}
+
+        # walk the slow tiers first so a copy on a faster tier wins
+        for no in reversed(range(len(self.tiers))):
+            tier = self.tiers[no]
+            usage = 0
+            for root, dirs, files in os.walk(str(tier.path)):
+                top = root == str(tier.path)
+                for name in files:
+                    file = Path(root) / name
+                    if top and name.startswith('tmp'):
+                        self._clean_temp(file)
+                        continue
+                    if name.endswith(('.part', INFO_SUFFIX)):
+                        continue
+
+                    try:
+                        stat = file.stat()
+                    except OSError:
+                        continue
+                    index[file.relative_to(tier.path).as_posix()] = Entry(no, stat.st_size, atime=stat.st_atime)
+                    usage += stat.st_size
+
+            app_log.info('tier %s holds %d bytes', tier.path, usage)
+
+        return index
+
+    def _scanned(self, future, callback):
+        self.scanning = False
+        try:
+            index = future.result()
+        except OSError as e:
+            app_log.error('unable to scan cache: %s', e)
+            index = {}
+
+        # objects committed or probed during the walk are newer than what it saw
+        for key, entry in self._index.items():
+            old = index.get(key)
+            if old is not None and old.tier != entry.tier:
+                self._unlink(self.tiers[old.tier].path, key)
+            index[key] = entry
+
+        self._index = index
+        self._recount()
+        app_log.info('indexed %d cached objects', len(index))
+
+        if len(self.tiers) > 1:
+            self.start_rebalance()
+
+        if callback is not None:
+            callback()
+
+    def _recount(self):
+        for tier in self.tiers:
+            tier.usage = 0
+        for entry in self._index.values():
+            self.tiers[entry.tier].usage += entry.size
+
+    def _clean_temp(self, file):
+        # a running transfer keeps writing its temp file, one left untouched this long is orphaned
+        try:
+            if file.stat().st_mtime < time() - self.STALE_TEMP:
+                app_log.info('remove orphaned %s', file)
+                file.unlink()
+        except OSError as e:
+            app_log.warning('unable to remove %s: %s', file, e)
+
+    def items(self):
+        for key, entry in list(self._index.items()):
+            yield key, self.tiers[entry.tier].path / key, entry.size
+
+    def path_for(self, key):
+        return self.fast.path / key
+
+    def tier_of(self, key):
+        """Return the tier holding ``key``, a url file lives with its object"""
+        if key.endswith(INFO_SUFFIX):
+            key = key[:-len(INFO_SUFFIX)] + DATA_SUFFIX
+        entry = self._index.get(key)
+        return self.tiers[entry.tier] if entry is not None else self.fast
+
+    def locate(self, key):
+        """Return ``(path, tier)`` for a cached object or ``None``"""
+        entry = self._index.get(key)
+        if entry is None:
+            if self.scanning or time() < self.probe_until:
+                entry = self._probe(key)
+            if entry is None:
+                return None
+
+        entry.hits += 1
+        entry.atime = time()
+
+        tier = self.tiers[entry.tier]
+        if entry.tier > 0 and entry.hits >= self.promote_hits:
+            self.move(key, entry.tier - 1)
+
+        return tier.path / key, tier
+
+    def _probe(self, key):
+        # not reached by the startup scan yet, or committed by a draining process
+        for no, tier in enumerate(self.tiers):
+            file = tier.path / key
+            if file.is_file():
+                entry = self._index[key] = Entry(no, file.stat().st_size)
+                tier.usage += entry.size
+                return entry
+        return None
+
+    def commit(self, temp_file, key):
+        file = self.path_for(key)
+        if not file.parent.exists():
+            file.parent.mkdir(parents=True)
+
+        temp_file = Path(temp_file)
+        size = temp_file.stat().st_size
+        temp_file.replace(file)
+
+        entry = self._index.get(key)
+        if entry is not None and entry.tier != 0:
+            self._unlink(self.tiers[entry.tier].path, key)
+
+        self._drop(key)
+        self._index[key] = Entry(0, size, hits=entry.hits if entry else 0)
+        self.fast.usage += size
+        return file
+
+    def discard(self, key):
+        entry = self._index.get(key)
+        if entry is None:
+            return
+
+        self._unlink(self.tiers[entry.tier].path, key)
+        self._drop(key)
+
+    @staticmethod
+    def _unlink(path, key):
+        for name in (key, sidecar(key)):
+            if name is not None and (path / name).exists():
+                (path / name).unlink()
+
+    def _drop(self, key):
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self.tiers[entry.tier].usage -= entry.size
+
+    def rebalance(self):
+        for no, tier in enumerate(self.tiers[:-1]):
+            if tier.capacity is None or tier.usage <= tier.capacity * self.HIGH_WATERMARK:
+                continue
+
+            target = tier.capacity * self.LOW_WATERMARK
+            candidates = sorted((e.hits, e.atime, k) for k, e in self._index.items()
+                                if e.tier == no and k not in self._moving)
+
+            excess = tier.usage - target
+            for _, _, key in candidates:
+                if excess <= 0:
+                    break
+                excess -= self._index[key].size
+                self.move(key, no + 1)
+
+        # age hit counters so frequency reflects recent use
+        for entry in self._index.values():
+            entry.hits >>= 1
+
+    def move(self, key, dest):
+        if key in self._moving:
+            return
+
+        entry = self._index[key]
+        if dest < entry.tier and not self.tiers[dest].has_room(entry.size):
+            return
+
+        src = entry.tier
+        src_path, dst_path = self.tiers[src].path, self.tiers[dest].path
+
+        app_log.debug('move %s to tier %d', key, dest)
+        self._moving.add(key)
+        future = self._executor.submit(self._copy, src_path, dst_path, key)
+        tornado.ioloop.IOLoop.current().add_future(
+            future, lambda f: self._moved(f, key, entry, src, dest))
+
+    @staticmethod
+    def _copy(src_path, dst_path, key):
+        try:
+            (dst_path / key).parent.mkdir(parents=True)
+        except FileExistsError:
+            pass
+
+        # the url file goes first, the object is only visible on the new tier with it
+        names = [key]
+        info = sidecar(key)
+        if info is not None and (src_path / info).exists():
+            names.insert(0, info)
+
+        for name in names:
+            dst_file = dst_path / name
+            temp_file = dst_file.with_name('.' + dst_file.name + '.part')
+            shutil.copy2(str(src_path / name), str(temp_file))
+            temp_file.replace(dst_file)
+
+    def _moved(self, future, key, entry, src, dest):
+        self._moving.discard(key)
+
+        if future.exception() is not None:
+            app_log.error('unable to move %s: %s', key, future.exception())
+            return
+
+        current = self._index.get(key)
+        if current is not entry or entry.tier != src:
+            # object was replaced or removed while copying
+            if current is None or current.tier != dest:
+                self._unlink(self.tiers[dest].path, key)
+            return
+
+        # swap the index first, requests already serving the old copy keep their descriptor
+        self.tiers[src].usage -= entry.size
+        self.tiers[dest].usage += entry.size
+        entry.tier = dest
+
+        self._unlink(self.tiers[src].path, key)
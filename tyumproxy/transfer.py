@@ -0,0 +1,359 @@
+"""
+Created on Oct 19, 2026
+
+@author: Azhar
+"""
+import asyncio
+import os
+from collections import deque
+from pathlib import Path
+from tempfile import mkstemp
+from urllib.parse import urlsplit
+
+from tornado.httputil import HTTPHeaders, format_timestamp
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition, Event
+from tornado.log import app_log
+
+from .checksum import is_metadata
+from .segment import SegmentedDownload
+from .upstream import Upstream, UpstreamError, is_encoded
+
+
+class Transfer(object):
+    """One upstream fetch feeding the cache and every client reading it.
+
+    Admitted 200 responses are written to a temporary file on the fast tier
+    and readers follow that file as it grows, so any number of clients can
+    share one fetch. Other responses go through a small memory buffer to
+    their only reader and upstream is read no faster than that reader
+    drains it. The fetch is cancelled as soon as its last reader leaves.
+    """
+    BUFFER_SIZE = 4 * 1024 * 1024
+    HASH_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, application, key, url, method='GET', headers=None, body=None, cache_file=None,
+                 cache_time=None, cache_info=None, cacheable=False, admit_rule=None):
+        self.application = application
+        self.key = key
+        self.url = url
+        self.method = method
+        self.request_headers = HTTPHeaders(headers or {})
+        self.body = body
+        self.cache_file = cache_file
+        self.cache_time = cache_time
+        self.cache_info = cache_info
+        self.cacheable = cacheable
+        self.admit_rule = admit_rule
+
+        self.code = None
+        self.reason = None
+        self.headers = None
+        self.ready = Event()
+        self.changed = Condition()
+
+        self.fd = None
+        self.temp_file = None
+        self.keep = False
+        self.hasher = None
+        self.hashed = 0
+        self.hashing = None
+        self.available = 0
+        self.buffer = deque()
+        self.buffered = 0
+
+        self.readers = set()
+        self.done = False
+        self.error = None
+        self.cancelled = False
+
+        self.job = None
+        self.task = None
+        self.upstream = None
+        self.download = None
+
+    @property
+    def shared(self):
+        return self.fd is not None and self.keep and not self.done and not self.cancelled
+
+    @property
+    def received(self):
+        """True once the whole body arrived, only the commit is left"""
+        if self.headers is None or is_encoded(self.headers) or not self.headers.get('Content-Length'):
+            return False
+        return self.available >= int(self.headers['Content-Length'])
+
+    @property
+    def timeout(self):
+        return int(self.application.settings['proxy']['timeout'])
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+        return self
+
+    def join(self, reader):
+        self.readers.add(reader)
+
+    def leave(self, reader):
+        if reader not in self.readers:
+            return
+
+        self.readers.discard(reader)
+        if self.readers:
+            return
+
+        if not self.done and not self.received:
+            app_log.info('no reader left for %s, cancel', self.url)
+            self.cancel()
+        self.close()
+
+    def cancel(self):
+        self.cancelled = True
+        # nobody may join while the task is still unwinding
+        if self.application.transfers.get(self.key) is self:
+            del self.application.transfers[self.key]
+
+        if self.upstream is not None:
+            self.upstream.abort('cancelled')
+        if self.download is not None:
+            self.download.cancel()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        try:
+            if self.application.segments.match(self.url) and self.cacheable and self.cache_time is None:
+                if await self.run_segmented():
+                    self.commit()
+                    return
+
+            await self.run_single()
+            self.commit()
+        except (UpstreamError, asyncio.CancelledError) as e:
+            self.fail('cancelled' if self.cancelled else str(e) or 'upstream error')
+        except Exception as e:
+            app_log.exception('transfer of %s failed', self.url)
+            self.fail(str(e))
+        finally:
+            if self.application.transfers.get(self.key) is self:
+                del self.application.transfers[self.key]
+
+            self.done = True
+            self.ready.set()
+            self.changed.notify_all()
+            if not self.readers:
+                self.close()
+
+    async def run_single(self):
+        headers = HTTPHeaders(self.request_headers)
+        if self.cache_time is not None:
+            headers['If-Modified-Since'] = format_timestamp(self.cache_time)
+
+        self.upstream = Upstream(self.url,
+                                 on_headers=self.process_header,
+                                 on_chunk=self.process_body,
+                                 method=self.method,
+                                 headers=headers,
+                                 body=self.body,
+                                 connect_timeout=self.timeout)
+
+        app_log.info('fetch %s', self.url)
+        async with self.application.scheduler.slot(self.url) as job:
+            self.job = job
+            await self.upstream.fetch()
+
+    async def run_segmented(self):
+        probe = Upstream(self.url, method='HEAD', headers=self.request_headers, connect_timeout=self.timeout)
+        self.upstream = probe
+
+        app_log.info('probe %s', self.url)
+        try:
+            async with self.application.scheduler.slot(self.url):
+                await probe.fetch()
+        except UpstreamError as e:
+            if self.cancelled:
+                raise
+            app_log.info('probe %s failed: %s', self.url, e)
+            return False
+
+        segments = self.application.segments
+        if probe.code != 200 or not segments.eligible(probe.response_headers):
+            return False
+
+        # a rejected probe falls back to a plain GET, leave its response alone
+        if not self.is_admitted(probe.response_headers):
+            return False
+
+        self.code, self.reason, self.headers = probe.code, probe.reason, probe.response_headers
+
+        size = int(self.headers['Content-Length'])
+        urls = self.application.mirrors.equivalents(self.url)
+        app_log.info('fetch %s in %d segments from %d mirrors', self.url, segments.count, len(urls))
+
+        self.open_cache()
+        self.download = SegmentedDownload(self.application.scheduler, urls, size, self.fd, segments.count,
+                                          self.request_headers, self.timeout, self.process_segments,
+                                          probe=self.headers)
+        self.ready.set()
+        try:
+            await self.download.run()
+        finally:
+            # the file must stay open until the hashing thread let go of it
+            if self.hashing is not None:
+                await self.hashing
+        return True
+
+    def is_admitted(self, headers):
+        size = None
+        if not is_encoded(headers) and headers.get('Content-Length'):
+            size = int(headers['Content-Length'])
+
+        admitted = self.application.admission.admit(self.key, self.admit_rule,
+                                                    size=size, content_type=headers.get('Content-Type'))
+        app_log.debug('admit %s as %s: %r', self.url, self.admit_rule, admitted)
+        return admitted
+
+    def open_cache(self):
+        app_log.debug('prepare temp file for %s', self.url)
+        self.fd, self.temp_file = mkstemp(dir=str(self.application.cache_path))
+        self.temp_file = Path(self.temp_file)
+        self.keep = True
+        if self.cacheable:
+            self.hasher = self.application.checksums.hasher(os.path.basename(urlsplit(self.url).path))
+
+        # later requests for the same object read along instead of fetching it again
+        self.application.transfers[self.key] = self
+
+    def abandon(self):
+        # readers already follow the file, keep writing to the unlinked inode for them
+        self.keep = False
+        self.temp_file.unlink()
+        if self.application.transfers.get(self.key) is self:
+            del self.application.transfers[self.key]
+
+    def process_header(self, upstream):
+        self.code, self.reason, self.headers = upstream.code, upstream.reason, upstream.response_headers
+        if self.code == 200 and self.is_admitted(self.headers):
+            self.open_cache()
+        self.ready.set()
+
+    async def process_body(self, chunk):
+        if self.fd is not None:
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(self.fd, view):]
+
+            if self.hasher is not None:
+                self.hasher.update(chunk)
+            self.available += len(chunk)
+
+            max_size = self.application.admission.rule(self.admit_rule).max_size
+            if self.keep and max_size is not None and self.available > max_size:
+                app_log.info('%s exceeds %d bytes, not caching', self.url, max_size)
+                self.abandon()
+        else:
+            self.buffer.append(chunk)
+            self.buffered += len(chunk)
+            self.available += len(chunk)
+
+        self.changed.notify_all()
+        await self.application.scheduler.throttle(self.job, len(chunk))
+
+        # backpressure, stop reading upstream until the reader catches up
+        while self.buffered > self.BUFFER_SIZE and not self.cancelled:
+            await self.changed.wait()
+
+    def process_segments(self):
+        if self.hasher is not None and (self.hashing is None or self.hashing.done()):
+            self.hashing = asyncio.ensure_future(self.hash_segments())
+
+        self.available = self.download.contiguous
+        self.changed.notify_all()
+
+    async def hash_segments(self):
+        # a late first segment can complete gigabytes at once, hash them off the loop
+        while self.hashed < self.download.contiguous and not self.cancelled:
+            size = min(self.download.contiguous - self.hashed, self.HASH_SIZE)
+            hashed = await IOLoop.current().run_in_executor(None, self.hash_range, self.hashed, size)
+            if not hashed:
+                break
+            self.hashed += hashed
+
+    def hash_range(self, offset, size):
+        hashed = 0
+        while hashed < size:
+            chunk = os.pread(self.fd, min(size - hashed, 1024 * 1024), offset + hashed)
+            if not chunk:
+                break
+            self.hasher.update(chunk)
+            hashed += len(chunk)
+        return hashed
+
+    def read(self, offset, size):
+        return os.pread(self.fd, size, offset)
+
+    def pop(self, size):
+        chunks, length = [], 0
+        while self.buffer and length < size:
+            chunk = self.buffer.popleft()
+            if length + len(chunk) > size:
+                self.buffer.appendleft(chunk[size - length:])
+                chunk = chunk[:size - length]
+            chunks.append(chunk)
+            length += len(chunk)
+
+        if chunks:
+            self.buffered -= length
+            self.changed.notify_all()
+        return b''.join(chunks)
+
+    def is_complete(self):
+        length = self.headers.get('Content-Length')
+        if length and not is_encoded(self.headers) and int(length) != self.available:
+            self.error = 'truncated, got {} of {} bytes'.format(self.available, length)
+            return False
+
+        if self.hasher is not None and not self.hasher.matches():
+            self.error = 'checksum mismatch, got {}'.format(sorted(self.hasher.digests()))
+            return False
+
+        return True
+
+    def commit(self):
+        app_log.info('code %s for %s', self.code, self.url)
+        if self.code == 304 and self.cache_file is not None and self.cache_file.exists():
+            self.cache_file.touch()
+            return
+
+        if self.fd is None or not self.keep:
+            return
+
+        if not self.is_complete():
+            app_log.error('%s %s', self.url, self.error)
+            self.abandon()
+            return
+
+        storage = self.application.storage
+        self.cache_file = storage.commit(self.temp_file, self.key)
+        self.keep = False
+        app_log.info('saved %s', self.cache_file)
+
+        if self.cache_info is not None:
+            with storage.path_for(self.cache_info).open('w') as f:
+                f.write(self.url)
+
+        if is_metadata(self.key):
+            self.application.checksums.load(self.cache_file)
+
+    def fail(self, reason):
+        if self.error is None:
+            self.error = reason
+        app_log.info('transfer of %s failed: %s', self.url, self.error)
+
+        if self.keep:
+            self.abandon()
+
+    def close(self):
+        if self.fd is not None and self.done:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,183 @@
+"""
+Created on Oct 19, 2026
+
+@author: Azhar
+"""
+import asyncio
+import ssl
+from urllib.parse import urljoin, urlsplit
+
+from tornado.http1connection import HTTP1Connection, HTTP1ConnectionParameters
+from tornado.httputil import HTTPHeaders, HTTPMessageDelegate, RequestStartLine
+from tornado.iostream import StreamClosedError
+from tornado.log import app_log
+from tornado.tcpclient import TCPClient
+
+CHUNK_SIZE = 256 * 1024
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+HOP_HEADERS = ('Connection', 'Proxy-Connection', 'Keep-Alive', 'Proxy-Authorization', 'TE', 'Trailer',
+               'Transfer-Encoding', 'Upgrade', 'Accept-Encoding')
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class Upstream(HTTPMessageDelegate):
+    """One HTTP/1.1 request whose body is handed to ``on_chunk`` as it arrives.
+
+    ``on_chunk`` may be a coroutine, the socket is not read again until it
+    returns so a slow consumer slows the upstream connection down instead of
+    piling up memory. ``abort`` closes the connection from anywhere, the
+    pending ``fetch`` then fails with ``UpstreamError``.
+    """
+    _tcp_client = None
+    _ssl_context = None
+
+    def __init__(self, url, on_headers=None, on_chunk=None, method='GET', headers=None, body=None,
+                 connect_timeout=None, follow_redirects=False, max_redirects=5):
+        self.url = url
+        self.on_headers = on_headers
+        self.on_chunk = on_chunk
+        self.method = method
+        self.headers = HTTPHeaders(headers or {})
+        self.body = body
+        self.connect_timeout = connect_timeout
+        self.max_redirects = max_redirects if follow_redirects else 0
+
+        self.code = None
+        self.reason = None
+        self.response_headers = None
+        self.received = 0
+        self.error = None
+
+        self._stream = None
+        self._redirect = None
+        self._finished = False
+
+        for header in HOP_HEADERS:
+            if header in self.headers:
+                del self.headers[header]
+
+    @classmethod
+    def tcp_client(cls):
+        if cls._tcp_client is None:
+            cls._tcp_client = TCPClient()
+        return cls._tcp_client
+
+    @classmethod
+    def ssl_context(cls):
+        if cls._ssl_context is None:
+            cls._ssl_context = ssl.create_default_context()
+        return cls._ssl_context
+
+    async def fetch(self):
+        """Return the response code, the body went to ``on_chunk``"""
+        for _ in range(self.max_redirects + 1):
+            await self._fetch_once()
+            if self._redirect is None:
+                return self.code
+
+            app_log.debug('redirect %s to %s', self.url, self._redirect)
+            self.url = urljoin(self.url, self._redirect)
+            if self.code == 303:
+                self.method, self.body = 'GET', None
+
+        raise UpstreamError('too many redirects for {}'.format(self.url))
+
+    async def _fetch_once(self):
+        url = urlsplit(self.url)
+        https = url.scheme == 'https'
+        port = url.port or (443 if https else 80)
+
+        self._redirect = None
+        self._finished = False
+        try:
+            self._stream = await self.tcp_client().connect(url.hostname, port,
+                                                           ssl_options=self.ssl_context() if https else None,
+                                                           timeout=self.connect_timeout)
+        except (OSError, StreamClosedError, asyncio.TimeoutError) as e:
+            raise UpstreamError('unable to connect {}: {}'.format(url.netloc, e))
+
+        if self.error is not None:
+            self._stream.close()
+            raise UpstreamError(self.error)
+
+        try:
+            connection = HTTP1Connection(self._stream, True, HTTP1ConnectionParameters(
+                no_keep_alive=True,
+                chunk_size=CHUNK_SIZE,
+                header_timeout=self.connect_timeout,
+                max_body_size=2 ** 63,
+                decompress=True,
+            ))
+
+            headers = HTTPHeaders(self.headers)
+            headers['Host'] = url.netloc
+            headers['Connection'] = 'close'
+            if self.body:
+                headers['Content-Length'] = str(len(self.body))
+
+            path = (url.path or '/') + ('?' + url.query if url.query else '')
+            await connection.write_headers(RequestStartLine(self.method, path, 'HTTP/1.1'), headers, self.body)
+            connection.finish()
+            await connection.read_response(self)
+        except StreamClosedError as e:
+            raise UpstreamError(self.error or 'connection to {} closed: {}'.format(url.netloc, e))
+        finally:
+            self._stream.close()
+            self._stream = None
+
+        if self.error is not None:
+            raise UpstreamError(self.error)
+        if not self._finished:
+            raise UpstreamError('connection to {} closed'.format(url.netloc))
+
+    def abort(self, reason):
+        if self.error is None:
+            self.error = reason
+        if self._stream is not None:
+            self._stream.close()
+
+    def headers_received(self, start_line, headers):
+        if self.max_redirects and start_line.code in REDIRECT_CODES and 'Location' in headers:
+            self._redirect = headers['Location']
+            return
+
+        self.code = start_line.code
+        self.reason = start_line.reason
+        self.response_headers = headers
+        if self.on_headers is not None:
+            try:
+                self.on_headers(self)
+            except Exception as e:
+                app_log.exception('unable to process headers of %s', self.url)
+                self.abort(str(e))
+
+    def data_received(self, chunk):
+        if self._redirect is not None or self.error is not None:
+            return
+
+        self.received += len(chunk)
+        if self.on_chunk is not None:
+            return self._deliver(chunk)
+
+    async def _deliver(self, chunk):
+        # exceptions raised here are swallowed by tornado, turn them into an abort instead
+        try:
+            await self.on_chunk(chunk)
+        except asyncio.CancelledError:
+            self.abort('cancelled')
+        except Exception as e:
+            app_log.exception('unable to process chunk of %s', self.url)
+            self.abort(str(e))
+
+    def finish(self):
+        self._finished = True
+
+    def on_connection_close(self):
+        pass
+
+
+def is_encoded(headers):
+    return 'Content-Encoding' in headers or 'X-Consumed-Content-Encoding' in headers
@@ -11,6 +11,18 @@ import yaml
 from . import yaml_anydict
 
 
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    if value is None or isinstance(value, int):
+        return value
+
+    value = str(value).strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+
+
 class UrlTranspose(object):
     FIELD = ['releasename', 'releasever', 'reponame', 'basearch', 'filename']
 